@@ -4,9 +4,11 @@ from .cm_helper import pretty_plot_confusion_matrix
 
 import os
 import math
+import numbers
 import copy
 import random
 import pickle
+import zipfile
 import torch
 from torch.utils.data.sampler import WeightedRandomSampler
 from torch.cuda.amp import autocast
@@ -19,26 +21,29 @@ import monai as mn
 import pytorch_lightning as pl
 
 from string import ascii_uppercase
-from sklearn.metrics import confusion_matrix
-from sklearn.model_selection import KFold, GroupKFold, StratifiedKFold, StratifiedGroupKFold
+from sklearn.model_selection import GroupKFold, StratifiedKFold, StratifiedGroupKFold
+from sklearn.utils import check_random_state
 
-def seed_all(seed:int) -> None:
+def seed_all(seed:int, deterministic:bool = False) -> None:
     """Seeds basic parameters for reproductibility of results.
 
     Args:
         seed (int): seed to use
+        deterministic (bool): force deterministic cuDNN kernels (disables cuDNN autotuning)
     """
     random.seed(seed)
     os.environ['PYTHONHASHSEED'] = str(seed)
     np.random.seed(seed)
     torch.manual_seed(seed)
-    torch.cuda.manual_seed(seed)
-    torch.backends.cudnn.deterministic = True
-    torch.backends.cudnn.benchmark = False
+    if torch.cuda.is_available():
+        torch.cuda.manual_seed_all(seed)
     mn.utils.misc.set_determinism(seed=seed)
     pl.seed_everything(seed,workers=True)
+    # set after MONAI, which forces deterministic cuDNN whenever a seed is given
+    torch.backends.cudnn.deterministic = deterministic
+    torch.backends.cudnn.benchmark = not deterministic
 
-def get_data_stats(dataset:torch.utils.data.Dataset, img_key:str, num_channels:int = 1, num_workers: int = 4) -> None:
+def get_data_stats(dataset:torch.utils.data.Dataset, img_key:str, num_channels:int = 1, num_workers: int = 4, batch_size: int = 1, device: Union[str, torch.device] = None) -> None:
     #########################################################################################################
     ### Adapted from: https://github.com/Nikronic/CoarseNet/blob/master/utils/preprocess.py#L142-L200
     #########################################################################################################
@@ -50,33 +55,42 @@ def get_data_stats(dataset:torch.utils.data.Dataset, img_key:str, num_channels:i
     - img_key: the key to extract the image tensor from the sample
     - num_channels: number of image channels
     - num_workers: number of processes to use for parallel computation
+    - batch_size: number of images reduced per step (images must share the same shape when > 1)
+    - device: device to run the reductions on (defaults to CUDA when available)
 
     Returns: None (prints mean and std)
     """
     def _compute_image_stats(image):
-        """Compute the sum, squared sum, and number of pixels for a single image."""
-        sum_ = image.sum()
-        sum_of_square = (image**2).sum()
-        nb_pixels = torch.prod(torch.tensor(image.shape)).item()
-        
-        return sum_, sum_of_square, nb_pixels
+        """Compute the per-channel pixel count, mean, and sum of squared deviations for a batch of images."""
+        x = image.transpose(0, 1).reshape(num_channels, -1).to(torch.float64)
+        nb_pixels = x.shape[1]
+        batch_mean = x.mean(1)
+        batch_m2 = ((x - batch_mean.unsqueeze(1))**2).sum(1)
+
+        return nb_pixels, batch_mean, batch_m2
 
-    dataloader = torch.utils.data.DataLoader(dataset, batch_size=1, shuffle=False, num_workers=num_workers)
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    device = torch.device(device)
 
-    # Initializations
+    dataloader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers, pin_memory=device.type == "cuda")
+
+    # Initializations (float64 accumulators to avoid numerical drift)
     cnt = 0
-    fst_moment = torch.zeros(num_channels)
-    snd_moment = torch.zeros(num_channels)
+    mean = torch.zeros(num_channels, dtype=torch.float64, device=device)
+    m2 = torch.zeros(num_channels, dtype=torch.float64, device=device)
 
-    # Using tqdm to show progress for data loading
-    for sample in tqdm(dataloader, desc="Computing mean"):
-        sum_, sum_of_square, nb_pixels = _compute_image_stats(sample[img_key])
-        fst_moment = (cnt * fst_moment + sum_) / (cnt + nb_pixels)
-        snd_moment = (cnt * snd_moment + sum_of_square) / (cnt + nb_pixels)
-        cnt += nb_pixels
+    # Single pass, per-channel Welford update merged with Chan's parallel formula
+    for sample in tqdm(dataloader, desc="Computing stats"):
+        nb_pixels, batch_mean, batch_m2 = _compute_image_stats(sample[img_key].to(device, non_blocking=True))
+        delta = batch_mean - mean
+        total = cnt + nb_pixels
+        mean += delta * nb_pixels / total
+        m2 += batch_m2 + delta**2 * cnt * nb_pixels / total
+        cnt = total
 
-    mean = fst_moment
-    std = torch.sqrt(snd_moment - fst_moment**2)
+    mean = mean.cpu()
+    std = torch.sqrt(m2 / cnt).cpu()
 
     print("Final Mean:", mean)
     print("Final Std:", std)
@@ -87,12 +101,12 @@ def one_hot_encode(true_labels: torch.Tensor, num_classes: int, smoothing=0.0):
     label_shape = torch.Size((true_labels.size(0), num_classes))
     if label_shape == true_labels.size():
         with torch.no_grad():
-            true_dist = torch.where(true_labels==1.0, confidence, smoothing)
+            true_dist = true_labels * (confidence - smoothing) + smoothing
     else:
         with torch.no_grad():
-            true_dist = torch.empty(size=label_shape, device=true_labels.device)
-            true_dist.fill_(smoothing / (num_classes - 1))
-            true_dist.scatter_(1, true_labels.data.unsqueeze(1), confidence)
+            off_value = smoothing / (num_classes - 1)
+            true_dist = torch.nn.functional.one_hot(true_labels.long(), num_classes).to(torch.get_default_dtype())
+            true_dist = true_dist * (confidence - off_value) + off_value
 
     return true_dist
 
@@ -102,17 +116,30 @@ def plot_confusion_matrix(preds:np.array, targets:np.array, columns:list=None, a
     if columns is None:
         columns = ['Class %s' %(i) for i in list(ascii_uppercase)[0:len(np.unique(targets))]]
 
-    matrix = confusion_matrix(targets, preds)
+    targets = np.asarray(targets).ravel()
+    preds = np.asarray(preds).ravel()
+    if len(targets) != len(preds):
+        raise ValueError(f"Found targets and preds with inconsistent lengths: {len(targets)} and {len(preds)}.")
+
+    labels, inverse = np.unique(np.concatenate([targets, preds]), return_inverse=True)
+    inverse = inverse.ravel()
+    num_labels = len(labels)
+    matrix = np.bincount(inverse[:len(targets)] * num_labels + inverse[len(targets):], minlength=num_labels * num_labels).reshape(num_labels, num_labels)
+
     df_cm = pd.DataFrame(matrix, index=columns, columns=columns)
 
     pretty_plot_confusion_matrix(df_cm, fz=fz, cmap=cmap, figsize=figsize, annot=annot, fmt=fmt, lw=lw, cbar=cbar, show_null_values=show_null_values, pred_val_axis=pred_val_axis, save_name = save_name)
 
 def load_weights(model: torch.nn.Module, weight_path: str = None):
-    weights = torch.load(weight_path)
-    model_dict = model.state_dict()
-    weights = {k: v for k, v in weights.items() if k in model_dict}
-    model_dict.update(weights) 
-    model.load_state_dict(model_dict)
+    torch_version = tuple(map(int, torch.__version__.split("+")[0].split('.')[:2]))
+    # only zipfile-format checkpoints (torch>=1.6 default) can be memory-mapped
+    if torch_version >= (2, 1) and zipfile.is_zipfile(weight_path):
+        weights = torch.load(weight_path, map_location="cpu", mmap=True)
+    else:
+        weights = torch.load(weight_path, map_location="cpu")
+    _, unexpected = model.load_state_dict(weights, strict=False)
+    if unexpected:
+        print(f"Skipped {len(unexpected)} checkpoint keys not found in the model: {unexpected}")
 
     return model
 
@@ -124,13 +151,14 @@ def add_weight_decay(models: Union[torch.nn.Module, List[torch.nn.Module]], weig
     if not isinstance(models, list):
         models = [models]
     
+    skip = frozenset(skip_list)
     decay = []
     no_decay = []
     for model in models:
         for name, param in model.named_parameters():
             if not param.requires_grad:
                 continue  # frozen weights
-            if len(param.shape) == 1 or name.endswith(".bias") or name in skip_list:
+            if param.ndim == 1 or name.endswith(".bias") or name in skip:
                 no_decay.append(param)
             else:
                 decay.append(param)
@@ -140,7 +168,7 @@ def add_weight_decay(models: Union[torch.nn.Module, List[torch.nn.Module]], weig
         {'params': decay, 'weight_decay': weight_decay},
     ]
         
-def is_notebook_running():
+def _detect_notebook():
     try:
         shell = get_ipython().__class__
         if 'google.colab._shell.Shell' in str(shell):
@@ -154,6 +182,12 @@ def is_notebook_running():
     except NameError:
         return False      # Probably standard Python interpreter
 
+# The interpreter type does not change during a process, so detect it once at import
+_IS_NOTEBOOK = _detect_notebook()
+
+def is_notebook_running():
+    return _IS_NOTEBOOK
+
 def split_data(df: pd.DataFrame, n_splits: int, y_column: str=None, group_column:str=None, fold_column: str="Fold", shuffle=False, random_state=None):
     df = df.copy()
 
@@ -162,8 +196,10 @@ def split_data(df: pd.DataFrame, n_splits: int, y_column: str=None, group_column
     elif shuffle and random_state is None:
         random_state = 42
 
+    folds = np.empty(len(df), dtype=np.int64)
+
     if y_column is None and group_column is None:
-        splitter = KFold(n_splits=n_splits, shuffle=shuffle, random_state=random_state)
+        splitter = None
         print("Using simple KFold split...")
     elif y_column is not None and group_column is None:
         splitter = StratifiedKFold(n_splits=n_splits, shuffle=shuffle, random_state=random_state)
@@ -177,10 +213,21 @@ def split_data(df: pd.DataFrame, n_splits: int, y_column: str=None, group_column
         splitter = StratifiedGroupKFold(n_splits=n_splits, shuffle=shuffle, random_state=random_state)
         print("Using StratifiedGroupKFold split...")
 
-    df[fold_column] = 0
+    if splitter is None:
+        if not isinstance(n_splits, numbers.Integral) or not 2 <= n_splits <= len(df):
+            raise ValueError(f"n_splits={n_splits} must be an integer of at least 2 and at most the number of samples ({len(df)}).")
+        # Same assignment as sklearn's KFold: contiguous folds over the (optionally shuffled) indices
+        indices = np.arange(len(df))
+        if shuffle:
+            check_random_state(random_state).shuffle(indices)
+        fold_sizes = np.full(n_splits, len(df) // n_splits, dtype=np.int64)
+        fold_sizes[:len(df) % n_splits] += 1
+        folds[indices] = np.repeat(np.arange(n_splits), fold_sizes)
+    else:
+        for fold_idx, (train_index, val_index) in enumerate(splitter.split(df, y=df[y_column].to_numpy() if y_column is not None else None, groups=df[group_column].to_numpy() if group_column is not None else None)):
+            folds[val_index] = fold_idx
 
-    for fold_idx, (train_index, val_index) in enumerate(splitter.split(df, y=df[y_column].tolist() if y_column is not None else None, groups=df[group_column].tolist() if group_column is not None else None)):
-        df.loc[val_index,fold_column]=fold_idx
+    df[fold_column] = folds
 
     return df
     